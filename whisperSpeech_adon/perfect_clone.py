@@ -22,62 +22,153 @@ from IPython.display import Markdown, HTML
 from whisperspeech.pipeline import Pipeline
 
 # let's start with the fast SD S2A model
-pipe = Pipeline(s2a_ref='collabora/whisperspeech:s2a-q4-tiny-en+pl.model')
+# the models are optimized below, once the batch size and dtype are known
+pipe = Pipeline(s2a_ref='collabora/whisperspeech:s2a-q4-tiny-en+pl.model', optimize=False)
 
+# decoding is memory-bound, so optimize() below casts the T2S/S2A weights to BF16
+# on GPUs with native BF16 (compute capability 8.0+, Ampere and newer) and to FP16
+# otherwise; the T4 (7.5) only emulates BF16, which is_bf16_supported() counts by
+# default. The vocoder is left alone, its iSTFT has no reason to run in reduced precision
+model_dtype = torch.bfloat16 if torch.cuda.get_device_capability()[0] >= 8 else torch.float16
 
-# CLONE any voice 1,2,3...
-
-path_to_target_voice = '/content/grandma_voice_longer.mp3'
+# preallocate static KV caches sized for the first phase (T2S at one row, S2A at one
+# row per clone) and torch.compile the per-token decode step in "reduce-overhead"
+# mode, which records it as a CUDA graph and replays it for every token.
+# Within a phase the caches stay on the GPU and are overwritten in place by each
+# call; the S2A cache is reallocated once, at one row, after the clones are made
+n_clones = 10
+pipe.t2s.optimize(max_batch_size=1, dtype=model_dtype, torch_compile=True)
+pipe.s2a.optimize(max_batch_size=n_clones, dtype=model_dtype, torch_compile=True)
 
-voice_embedding = pipe.extract_spk_emb(path_to_target_voice)
 
-assert type(grandmas_voice_embedding) == torch.Tensor, f'Voice is not a torch.Tensor it is: type(grandmas_voice_embedding)'
+# CLONE any voice 1,2,3...
 
-generated_clones = []
+path_to_target_voice = '/content/grandma_voice_longer.mp3'
 
-for clone_id in range(10):
-  clone = pipe.generate_to_file(f"clone_{clone_id}.mp3","Alesz to magia",grandmas_voice_embedding,lang="pl")
-  generated_clones.append(clone)
-  print(f'Created clone {clone_id}!')\
+import os
+import hashlib
+
+spk_cache_dir = '/content/.spk_cache'
+
+def cached_spk_emb(path):
+  # the embedding only depends on the audio bytes, so reuse it across runs
+  with open(path, 'rb') as f:
+    digest = hashlib.blake2b(f.read(), digest_size=16).hexdigest()
+  cache_path = os.path.join(spk_cache_dir, f'{digest}.pt')
+  if os.path.exists(cache_path):
+    return torch.load(cache_path, map_location='cuda')
+  emb = pipe.extract_spk_emb(path)
+  os.makedirs(spk_cache_dir, exist_ok=True)
+  torch.save(emb, cache_path)
+  return emb
+
+speaker_emb = cached_spk_emb(path_to_target_voice)
+
+import torchaudio
+
+def generate_clones(text, speaker, n_clones, lang="pl", cps=15):
+  # T2S runs once, as in Pipeline.generate_atoks, so every clone shares one token
+  # sequence ending at its EOT; S2A's bs then samples n_clones voicings of it in one
+  # batch, and the vocoder decodes them together
+  with torch.inference_mode():
+    stoks = pipe.t2s.generate(text, cps=cps, lang=lang)[0]
+    atoks = pipe.s2a.generate(stoks, speaker.unsqueeze(0), bs=n_clones)
+    audio = pipe.vocoder.decode(atoks).cpu()
+
+  fnames = []
+  for clone_id in range(n_clones):
+    fname = f"clone_{clone_id}.mp3"
+    torchaudio.save(fname, audio[clone_id].reshape(1, -1), 24000)
+    fnames.append(fname)
+    print(f'Created clone {clone_id}!')
+  return fnames
+
+# keep the file names: any of them can be passed back to the pipeline as a speaker
+generated_clones = generate_clones("Alesz to magia", speaker_emb, n_clones=n_clones)
+
+# every later call decodes one line at a time, and the KV cache batch has to match
+# the call's batch, so shrink the S2A cache back to a single row
+pipe.s2a.setup_kv_cache(1)
+
+# throwaway generation so the single-line graphs are captured before the real runs below
+pipe.generate("Rozgrzewka", speaker_emb, lang="pl")
 
 print('Now listen to each file and choose the best match!')
 
 # Cell 1: Create an input box
-my_favorite = input("Which voice sounds the best?: ")
-assert int(my_favorite)
+# input() returns a str, so turn it into a list index and ask again on a bad
+# answer instead of failing after the clones have already been generated
+while True:
+  answer = input(f"Which voice sounds the best? (0-{len(generated_clones) - 1}): ")
+  try:
+    my_favorite = int(answer)
+  except ValueError:
+    my_favorite = -1
+  if 0 <= my_favorite < len(generated_clones):
+    break
+  print(f'Please enter a clone number between 0 and {len(generated_clones) - 1}.')
 
 
 link_to_my_text = r'/content/three_roses.txt'
 
-line_count = 0
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
 with open(link_to_my_text, 'r') as f:
-  for line in f.read().splitlines():
-    if line.strip() != '':
-      #create audio snippet
-      line_count +=1
-      line = line.strip()
-      pipe.generate_to_file(text=line,fname=f"/content/clone_audio/clone_{line_count}.mp3", speaker=generated_clones[my_favorite], lang='pl', cps=15, step_callback=None)
+  # stream the file and strip each line once, dropping blank ones
+  lines = [stripped for line in f if (stripped := line.strip())]
+
+# one line per call: T2S stops each line at its own end-of-text token, so no
+# padding reaches S2A and every clip ends where its line does
+favorite_speaker = pipe.extract_spk_emb(generated_clones[my_favorite])
+
+# MP3 encoding runs on a CPU thread while the GPU synthesizes the next line;
+# at most two clips wait for it, and waiting on the oldest re-raises any error
+# from the encoder here, which stops synthesis
+max_pending_encodes = 2
+pending_encodes = deque()
+with ThreadPoolExecutor(max_workers=1) as encoder:
+  for line_count, line in enumerate(lines, start=1):
+    #create audio snippet
+    audio = pipe.generate(line, speaker=favorite_speaker, lang='pl', cps=15)
+    fname = f"/content/clone_audio/clone_{line_count}.mp3"
+    pending_encodes.append(encoder.submit(torchaudio.save, fname, audio.cpu(), 24000))
+    if len(pending_encodes) > max_pending_encodes:
+      pending_encodes.popleft().result()
+  for future in pending_encodes:
+    future.result()
 
 
 import os
-import glob
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 from pydub import AudioSegment
 
 def concatenate_audio(directory_path, output_file):
-    # Change to the specified directory
-    os.chdir(directory_path)
+    directory = Path(directory_path).resolve()
 
-    # Get a list of audio files in the directory
-    audio_files = sorted(glob.glob("*.mp3"))
+    # Get a list of audio files in the directory, as absolute paths so the
+    # process working directory is left alone
+    audio_files = sorted(directory.glob("*.mp3"))
 
-    # Concatenate audio files
+    # Concatenate audio files: collect the raw PCM and join it once, since
+    # AudioSegment += copies everything accumulated so far on every step
     combined_audio = AudioSegment.silent()
-    for audio_file in audio_files:
-        audio_segment = AudioSegment.from_file(audio_file, format="mp3")
-        combined_audio += audio_segment
-
-    # Export the concatenated audio to a single MP3 file
-    combined_audio.export(output_file, format="mp3")
+    # each decode is an ffmpeg subprocess, so threads let them run side by side
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        audio_segments = list(executor.map(lambda f: AudioSegment.from_file(f, format="mp3"), audio_files))
+    if audio_segments:
+        # like +=, bring every segment (leading silence included) up to the highest
+        # frame rate, channel count and sample width among them
+        segments = [combined_audio] + audio_segments
+        frame_rate = max(seg.frame_rate for seg in segments)
+        channels = max(seg.channels for seg in segments)
+        sample_width = max(seg.sample_width for seg in segments)
+        segments = [seg.set_frame_rate(frame_rate).set_channels(channels).set_sample_width(sample_width) for seg in segments]
+        combined_audio = segments[0]._spawn(b"".join(seg.raw_data for seg in segments))
+
+    # Export the concatenated audio to a single MP3 file (relative names land in the directory)
+    combined_audio.export(directory / output_file, format="mp3")
 
 # if __name__ == "__main__":
 #     import argparse
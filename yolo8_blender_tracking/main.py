@@ -1,16 +1,33 @@
+import os
 import bpy
+import gpu
 import numpy as np
-import cv2
+import torch
+from PIL import Image
 from yolov8.detect import DetectPredictor
 
+# Directory written by: yolo export model=yolov8n.pt format=openvino int8=True
+OPENVINO_MODEL_DIR = 'yolov8n_int8_openvino_model'
+
+# Engines whose Rendered viewport shading matches their final render in a single draw.
+# EEVEE is not one of them: it compiles shaders asynchronously and accumulates
+# anti-aliasing, soft shadows and AO over many samples, so one draw is a rough preview
+OFFSCREEN_ENGINES = {'BLENDER_WORKBENCH'}
+
+def render_size(scene):
+    # Pixel size of the camera's final render, resolution percentage included
+    render = scene.render
+    scale = render.resolution_percentage / 100
+    return int(render.resolution_x * scale), int(render.resolution_y * scale)
+
 class YOLOv8MotionTracker(bpy.types.Operator):
     """Use YOLOv8 for advanced motion tracking in Blender"""
     bl_idname = "object.yolov8_motion_tracker"
     bl_label = "YOLOv8 Motion Tracker"
     bl_options = {'REGISTER', 'UNDO'}
 
-    def __init__(self):
-        self.predictor = DetectPredictor(model='yolov8n.pt')
+    # Loaded on the first invocation and shared by every later one
+    _predictor = None
 
     def invoke(self, context, event):
         # Get current 3D view and active camera
@@ -21,67 +38,136 @@ class YOLOv8MotionTracker(bpy.types.Operator):
             self.report({'ERROR'}, "No active camera found in the scene.")
             return {'CANCELLED'}
 
+        # Load the model once; a missing model file or GPU fails this operator, not the add-on
+        if YOLOv8MotionTracker._predictor is None:
+            try:
+                YOLOv8MotionTracker._predictor = load_predictor()
+            except Exception as e:
+                self.report({'ERROR'}, f"Failed to load the YOLOv8 model: {e}")
+                return {'CANCELLED'}
+
         # Capture frame from camera
-        frame = self.capture_frame(camera)
+        frame = self.capture_frame(context, camera)
 
         if frame is None:
             self.report({'ERROR'}, "Failed to capture frame from the camera.")
             return {'CANCELLED'}
 
-        # Run YOLOv8 object detection
-        results = self.predictor(frame)
+        # Run YOLOv8 object detection; both backends take BGR arrays, like cv2.imread returns
+        results = YOLOv8MotionTracker._predictor(np.ascontiguousarray(frame[..., ::-1]))
 
         # Process YOLOv8 results and update Blender motion tracking
         self.update_motion_tracking(results, camera)
 
         return {'FINISHED'}
 
-    def capture_frame(self, camera):
+    def capture_frame(self, context, camera):
         # Render the scene from the camera's perspective to an offscreen buffer
-        scene = bpy.context.scene
-        render = bpy.context.scene.render
+        scene = context.scene
+        render = scene.render
+        in_view3d = context.space_data is not None and context.space_data.type == 'VIEW_3D'
+        if in_view3d and render.engine in OFFSCREEN_ENGINES:
+            return self.capture_frame_offscreen(context, camera)
+
+        # Outside a 3D viewport there is nothing to draw into, and EEVEE and Cycles need
+        # more than one viewport draw to converge, so fall back to a still render
         render.filepath = "//temp_render.png"
         bpy.ops.render.render(write_still=True)
 
         # Load the rendered image as a numpy array
         image_path = bpy.path.abspath(render.filepath)
-        frame = cv2.imread(image_path)
-        if frame is not None:
-            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-        return frame
+        # Decode straight to RGB instead of decoding to BGR and shuffling the channels after
+        try:
+            with Image.open(image_path) as image:
+                return np.asarray(image.convert('RGB'))
+        except OSError:
+            return None
+
+    def capture_frame_offscreen(self, context, camera):
+        # Draw the camera view straight into GPU memory and read the pixels back,
+        # skipping the PNG encode, disk write and decode of a still render
+        scene = context.scene
+        width, height = render_size(scene)
+
+        view_matrix = camera.matrix_world.inverted()
+        projection_matrix = camera.calc_matrix_camera(
+            context.evaluated_depsgraph_get(), x=width, y=height
+        )
+
+        # draw_view3d uses the viewport's shading and overlays, so switch to Rendered
+        # shading without overlays for the draw to match the camera's final render
+        space = context.space_data
+        shading_type = space.shading.type
+        show_overlays = space.overlay.show_overlays
+        space.shading.type = 'RENDERED'
+        space.overlay.show_overlays = False
+
+        offscreen = gpu.types.GPUOffScreen(width, height)
+        try:
+            with offscreen.bind():
+                offscreen.draw_view3d(
+                    scene,
+                    context.view_layer,
+                    context.space_data,
+                    context.region,
+                    view_matrix,
+                    projection_matrix,
+                    do_color_management=True,
+                )
+                framebuffer = gpu.state.active_framebuffer_get()
+                buffer = framebuffer.read_color(0, 0, width, height, 4, 0, 'UBYTE')
+        finally:
+            offscreen.free()
+            space.shading.type = shading_type
+            space.overlay.show_overlays = show_overlays
+
+        # The buffer is bottom-up RGBA; flip it and drop alpha to get top-down RGB
+        frame = np.asarray(buffer, dtype=np.uint8).reshape(height, width, 4)
+        return np.ascontiguousarray(frame[::-1, :, :3])
 
     def update_motion_tracking(self, results, camera):
         # Process YOLOv8 detection results and update Blender motion tracking data
-        for detection in results.boxes:
-            # Get bounding box coordinates
-            x1, y1, x2, y2 = map(int, detection.xyxy[0])
-
-            # Convert 2D bounding box to 3D position in camera space
-            position_3d = self.project_to_3d(x1, y1, x2, y2, camera)
-
-            if position_3d:
-                # Add or update motion tracking marker in Blender
-                self.add_motion_tracking_marker(position_3d)
-
-    def project_to_3d(self, x1, y1, x2, y2, camera):
-        # Estimate 3D position based on bounding box center and camera parameters
-        scene = bpy.context.scene
-        render = scene.render
-        bbox_center_x = (x1 + x2) / 2
-        bbox_center_y = (y1 + y2) / 2
+        boxes = results.boxes.xyxy
+        if hasattr(boxes, 'cpu'):
+            boxes = boxes.cpu().numpy()
+        # Truncate to whole pixels, as the per-box int() conversion did
+        boxes = np.asarray(boxes).astype(np.int64)
+        if len(boxes) == 0:
+            return
+
+        # Convert all 2D bounding boxes to 3D positions in camera space at once
+        unproject = self.unprojection_matrix(bpy.context, camera)
+        positions_3d = self.project_to_3d(boxes, unproject)
+
+        for position_3d in positions_3d:
+            # Add or update motion tracking marker in Blender
+            self.add_motion_tracking_marker(position_3d)
+
+    def unprojection_matrix(self, context, camera):
+        # Fuse the camera's world matrix and inverse projection into one 4x4 matrix per frame
+        width, height = render_size(context.scene)
+        projection = camera.calc_matrix_camera(
+            context.evaluated_depsgraph_get(), x=width, y=height
+        )
+        return np.asarray(camera.matrix_world) @ np.linalg.inv(np.asarray(projection))
+
+    def project_to_3d(self, boxes, unproject):
+        # Estimate 3D positions based on bounding box centers and the unprojection matrix
+        bbox_centers = (boxes[:, :2] + boxes[:, 2:]) / 2
 
         # Normalize coordinates to -1 to 1 range (screen space)
-        normalized_x = (bbox_center_x / render.resolution_x) * 2 - 1
-        normalized_y = (bbox_center_y / render.resolution_y) * 2 - 1
+        resolution = np.array(render_size(bpy.context.scene))
+        normalized = (bbox_centers / resolution) * 2 - 1
 
-        # Use Blender's camera matrix for unprojection
         depth = 1.0  # Assumes objects are at a fixed depth for simplicity
-        coord_3d = camera.matrix_world @ camera.calc_matrix_camera(
-            scene.render.resolution_x / scene.render.resolution_y
-        ).inverted() @ np.array([normalized_x, normalized_y, -depth, 1.0])
+        homogeneous = np.empty((len(boxes), 4))
+        homogeneous[:, :2] = normalized
+        homogeneous[:, 2] = -depth
+        homogeneous[:, 3] = 1.0
+        coords_3d = homogeneous @ unproject.T
 
         # Convert to world space and return
-        return coord_3d[:3]
+        return coords_3d[:, :3]
 
     def add_motion_tracking_marker(self, position_3d):
         # Add or update a motion tracking marker in the Blender scene
@@ -101,8 +187,21 @@ class YOLOv8MotionTracker(bpy.types.Operator):
         # Set the marker's keyframe
         marker.markers.insert(frame=bpy.context.scene.frame_current, co=position_3d)
 
+def load_predictor():
+    # Prefer the INT8 OpenVINO export when it exists, otherwise run the PyTorch model,
+    # in FP16 when a GPU is available. Both backends return one result per image, so
+    # each is wrapped to return the single result for the frame it was given
+    if os.path.isdir(OPENVINO_MODEL_DIR):
+        from ultralytics import YOLO
+        model = YOLO(OPENVINO_MODEL_DIR, task='detect')
+        return lambda frame: model(frame, verbose=False)[0]
+    cuda = torch.cuda.is_available()
+    predictor = DetectPredictor(model='yolov8n.pt', half=cuda, device=0 if cuda else 'cpu')
+    return lambda frame: predictor(frame)[0]
+
 def register():
     bpy.utils.register_class(YOLOv8MotionTracker)
 
 def unregister():
     bpy.utils.unregister_class(YOLOv8MotionTracker)
+    YOLOv8MotionTracker._predictor = None